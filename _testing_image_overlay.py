@@ -1,13 +1,23 @@
 import os
 import math
+from functools import lru_cache
 from typing import Tuple, Optional
 
 from PIL import Image, ImageDraw, ImageFont
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
-import pandas as pd
 from PIL import ExifTags, ImageFilter
-import piexif
+import numpy as np
+
+
+ORIENTATION_TAG = 0x0112  # EXIF Orientation
+
+# Looked up through Pillow's font search (e.g. the Windows Fonts folder).
+# Use a full path instead if the font lives elsewhere on your system.
+FONT_PATH = "consola.ttf"
+
+# Overlay text that is the same on every image; rendered once and reused
+FIXED_LABELS = frozenset({"DIRECTION", "ACCURACY 10 m", "DATUM WGS84"})
 
 
 # %% Functions
@@ -41,6 +51,9 @@ def calculate_initial_compass_bearing(lat1: float, lon1: float, lat2: float, lon
 
 
 def save_image_with_metadata(image_path: str, metadata: dict) -> None:
+    # piexif is only needed on this (rare) write path
+    import piexif
+
     # Open the image
     img = Image.open(image_path)
 
@@ -66,6 +79,23 @@ def save_image_with_metadata(image_path: str, metadata: dict) -> None:
     img.close()
 
 
+def _save_overlay_image(image: Image.Image, path: str, image_format: str, **params) -> None:
+    """
+    Save an overlay result. It is written to a per-process temporary file and
+    moved into place, so parallel workers saving to the same name never see a
+    half-written file; the last one to finish wins. The temporary file is
+    removed if saving fails.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        image.save(tmp_path, image_format, **params)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
 def _rational_to_float(value) -> float:
     """
     Convert a rational EXIF value (num, den) or plain number to float.
@@ -77,6 +107,22 @@ def _rational_to_float(value) -> float:
         return float(value)
 
 
+def _output_exif(img: Image.Image) -> bytes:
+    """
+    EXIF bytes to embed in a saved overlay: the source EXIF with Orientation
+    reset to 1, since the overlay is drawn on the stored pixel layout.
+    """
+    exif_data = img.info.get("exif", b"")
+    if not exif_data:
+        return b""
+
+    exif = Image.Exif()
+    exif.load(exif_data)
+    if ORIENTATION_TAG in exif:
+        exif[ORIENTATION_TAG] = 1
+    return exif.tobytes()
+
+
 def get_decimal_from_dms(dms) -> float:
     """
     Convert DMS tuple from EXIF (each item may be rational) to decimal degrees.
@@ -89,38 +135,94 @@ def get_decimal_from_dms(dms) -> float:
 
 def get_comments_info(image_path: str) -> Optional[Tuple[float, float, str, str, float]]:
     """
-    Read GPS coordinates, date/time and bearing from image EXIF.
-    Returns (lat, lon, date_str, time_str, bearing_degrees) or None if not available.
+    Read GPS coordinates, date/time and camera direction from image EXIF.
+    Returns (lat, lon, date_str, time_str, direction_degrees) or None if not available.
+    The direction is 0.0 when the image has no GPSImgDirection tag.
+    """
+    with Image.open(image_path) as img:
+        return get_comments_info_from_img(img)
+
+
+def get_comments_info_from_img(img: Image.Image) -> Optional[Tuple[float, float, str, str, float]]:
+    """
+    Same as get_comments_info, but for an image that is already open.
     """
     GPS_TAG = 34853           # GPSInfo
+    EXIF_IFD_TAG = 34665      # ExifOffset
     DATETIME_ORIGINAL = 36867 # DateTimeOriginal
 
-    with Image.open(image_path) as img:
-        info = img._getexif() or {}
+    # getexif() is cached on the image and only decodes the IFDs asked for
+    exif = img.getexif()
+    data_dict = exif.get_ifd(GPS_TAG)
+    date_time_str = exif.get_ifd(EXIF_IFD_TAG).get(DATETIME_ORIGINAL)
 
-    if GPS_TAG not in info or DATETIME_ORIGINAL not in info:
+    if not data_dict or date_time_str is None:
         return None
 
-    data_dict = info[GPS_TAG]
-
     # GPSLatitude is tag 2, GPSLongitude is tag 4 in the GPS IFD
     cord1 = get_decimal_from_dms(data_dict[2])
     cord2 = get_decimal_from_dms(data_dict[4])
 
-    date_time_str = info[DATETIME_ORIGINAL]  # e.g. "2025:11:24 10:23:45"
+    # e.g. "2025:11:24 10:23:45"
     parts = date_time_str.split(" ")
     date_month_year = parts[0].replace(":", "-")
     hour_min_second = parts[1] if len(parts) > 1 else ""
 
-    angle = calculate_initial_compass_bearing(
-        lat1=cord1, lon1=cord2, lat2=0.0, lon2=0.0
-    )
+    # GPSImgDirection (tag 17) is the compass direction the camera was facing
+    img_dir_raw = data_dict.get(17)
+    angle = _rational_to_float(img_dir_raw) if img_dir_raw is not None else 0.0
 
     return cord1, cord2, date_month_year, hour_min_second, angle
 
 
+def load_image(image_path: str, max_dim: Optional[int] = None) -> Image.Image:
+    """
+    Open and fully decode an image.
+    If max_dim is given, the image is shrunk so neither side exceeds it; for
+    JPEGs libjpeg does most of that during decoding (1/2, 1/4 or 1/8 scale).
+    The applied factor (1.0 if none) is kept in img.info["scale"], so fixed
+    pixel offsets in the overlays can follow it.
+    """
+    img = Image.open(image_path)
+    src_width, src_height = img.size
+    scale = 1.0 if max_dim is None else max_dim / max(src_width, src_height)
+
+    if scale < 1:
+        # draft() needs the aspect-preserving target; a square bound would only
+        # let libjpeg scale when both sides are at least twice max_dim
+        img.draft("RGB", (math.ceil(src_width * scale), math.ceil(src_height * scale)))
+        img.load()
+        img.thumbnail((max_dim, max_dim))
+        img.info["scale"] = img.height / src_height
+    else:
+        img.load()
+        img.info["scale"] = 1.0
+    return img
+
+
+@lru_cache(maxsize=16)
+def _get_font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    Load the overlay font once per size; creating a FreeType face parses the whole file.
+    """
+    return ImageFont.truetype(FONT_PATH, size=size)
+
+
+@lru_cache(maxsize=256)
+def _render_label(text: str, size: int) -> Image.Image:
+    """
+    Render `text` once as an "L" coverage mask, positioned as draw.text at (0, 0) would.
+    Cached per (text, size), so callers must not modify the returned image.
+    """
+    font = _get_font(size)
+    _, _, right, bottom = font.getbbox(text)
+    label = Image.new("L", (max(1, right), max(1, bottom)), 0)
+    ImageDraw.Draw(label).text((0, 0), text, fill=255, font=font)
+    return label
+
+
 def create_standardized_overlay_image(
-    image_path: str,
+    img: Image.Image,
     cord1: float,
     cord2: float,
     date_month_year: str,
@@ -133,20 +235,24 @@ def create_standardized_overlay_image(
     idd: int,
     output_folder: str,
 ) -> str:
-    """Create an overlay with text and save a combined image."""
-    with Image.open(image_path) as img:
-        base_width, base_height = img.size
+    """
+    Create an overlay with text and save a combined image.
+    `img` is the already-open base image; it is not closed here.
+    `output_folder` must already exist.
+    """
+    base_width, base_height = img.size
 
     text_size = int(base_height * 0.027)
     box_height = base_height // 12
-
-    overlay_image = Image.new("RGBA", (base_width, base_height), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(overlay_image, "RGBA")
+    # Extra drop for the second line of each box: 20 px at the photo's own
+    # resolution, scaled down with it when load_image() downscaled the image
+    line_gap = round(20 * img.info.get("scale", 1.0))
 
     transparency = 128
 
-    # Adjust font path if needed for your system
-    font = ImageFont.FreeTypeFont(r"C:\Windows\Fonts\CONSOLA.ttf", size=text_size)
+    font = _get_font(text_size)
+    ascent, descent = font.getmetrics()
+    text_height = ascent + descent
 
     def draw_boxes_with_text(y_position: int, text_lines):
         """
@@ -156,7 +262,20 @@ def create_standardized_overlay_image(
             ["-31.12345°S", "115.12345°E"],
             ...
         ]
+        The boxes are drawn on a transparent layer only as tall as the boxes
+        plus any text running past their edges, instead of a full-frame overlay.
+        Returns (layer, layer_top), layer_top being its y in the base image.
         """
+        # draw.rectangle includes its bottom row (y_position + box_height), so the
+        # exclusive end of the boxes is one past it
+        boxes_end = y_position + box_height + 1
+        layer_top = max(0, y_position - text_height)
+        layer_bottom = min(base_height, boxes_end + line_gap + 2 * text_height)
+        layer = Image.new("RGBA", (base_width, layer_bottom - layer_top), (255, 255, 255, 0))
+        draw = ImageDraw.Draw(layer, "RGBA")
+
+        # From here on, y is relative to the layer
+        y_position -= layer_top
         num_boxes = len(text_lines)
         box_width = base_width // num_boxes
         for i, lines in enumerate(text_lines):
@@ -171,15 +290,13 @@ def create_standardized_overlay_image(
                 else:
                     line = str(line)
 
-                text_bbox = draw.textbbox((0, 0), line, font=font)
-                text_width = text_bbox[2] - text_bbox[0]
-                text_height = text_bbox[3] - text_bbox[1]
+                text_width = int(font.getlength(line))
                 text_x = x_position + (box_width - text_width) // 2
 
                 if j == 1:
                     text_y = (
                         y_position
-                        + 20
+                        + line_gap
                         + (box_height - text_height * len(lines)) // 2
                         + (text_height * j)
                     )
@@ -190,7 +307,13 @@ def create_standardized_overlay_image(
                         + (text_height * j)
                     )
 
-                draw.text((text_x, text_y), line, fill="white", font=font)
+                if line in FIXED_LABELS:
+                    layer.paste((255, 255, 255, 255), (text_x, text_y),
+                                _render_label(line, text_size))
+                else:
+                    draw.text((text_x, text_y), line, fill="white", font=font)
+
+        return layer, layer_top
 
     # Nicely formatted text content
     top_boxes_text = [
@@ -206,26 +329,28 @@ def create_standardized_overlay_image(
     ]
 
     # Draw top and bottom boxes
-    draw_boxes_with_text(0, top_boxes_text)  # Top boxes
-    draw_boxes_with_text(base_height - box_height, bottom_boxes_text)  # Bottom boxes
-
-    # Combine overlay with base image
-    with Image.open(image_path) as base_img:
-        combined_image = Image.alpha_composite(base_img.convert("RGBA"), overlay_image)
+    layers = [
+        draw_boxes_with_text(0, top_boxes_text),  # Top boxes
+        draw_boxes_with_text(base_height - box_height, bottom_boxes_text),  # Bottom boxes
+    ]
 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    # Combine the layers with the base image, each using its own alpha as mask
+    combined_image = img.convert("RGB")
+    for layer, layer_top in layers:
+        combined_image.paste(layer, (0, layer_top), layer)
 
     # Build filename
-    combined_image_name = f"{glocation}_{component}_{defect_line1}_{defect_line2}_{idd}.png"
+    combined_image_name = f"{glocation}_{component}_{defect_line1}_{defect_line2}_{idd}.jpg"
     combined_image_path = os.path.join(output_folder, combined_image_name)
 
-    combined_image.save(combined_image_path)
+    # The result is opaque, so JPEG is much faster to encode than PNG
+    _save_overlay_image(combined_image, combined_image_path, "JPEG", quality=90, subsampling=2,
+                        exif=_output_exif(img))
 
     return combined_image_path
 
 def create_partial_overlay_image(
-    image_path: str,
+    base_img: Image.Image,
     cord1: float,
     cord2: float,
     date_month_year: str,
@@ -238,27 +363,22 @@ def create_partial_overlay_image(
     idd: int,
     output_folder: str,
 ) -> str:
-    """Create an overlay with text and save a combined image."""
-
-    # ---- OPEN IMAGE ONCE (SAFE) ----
-    base_img = Image.open(image_path)
+    """
+    Create an overlay with text and save a combined image.
+    `base_img` is the already-open base image; the box area is blurred in
+    place and the image is not closed here. `output_folder` must already exist.
+    """
     base_width, base_height = base_img.size
 
-    # ---- OVERLAY SURFACE ----
-    overlay_image = Image.new("RGBA", (base_width, base_height), (255,255,255,0))
-    draw = ImageDraw.Draw(overlay_image, "RGBA")
-
     # ---- STYLING ----
     text_size = int(base_height * 0.035)
     box_height = base_height // 12 - base_height / 240
     transparency = 200
-    font = ImageFont.FreeTypeFont(r"C:\Windows\Fonts\CONSOLA.ttf", size=text_size)
+    font = _get_font(text_size)
 
     # ---- DRAW ONLY YOUR CUSTOM CONTEXT-AWARE BOX ----
-    draw_bottom_left_box(
-        overlay_image,
-        base_img,        # <-- OPEN IMAGE, NOT CLOSED
-        draw,
+    layer, layer_top = draw_bottom_left_box(
+        base_img,
         base_width,
         base_height,
         box_height,
@@ -268,20 +388,17 @@ def create_partial_overlay_image(
         component
     )
 
-    # ---- MERGE LAYERS ----
-    combined_image = Image.alpha_composite(base_img.convert("RGBA"), overlay_image)
-
-    # Close base image now that we're done using it
-    base_img.close()
+    # ---- MERGE LAYERS (bottom strip only, using its own alpha as mask) ----
+    combined_image = base_img.convert("RGB")
+    combined_image.paste(layer, (0, layer_top), layer)
 
     # ---- SAVE ----
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    combined_image_name = f"{glocation}_{component}_{defect_line1}_{defect_line2}_{idd}.png"
+    combined_image_name = f"{glocation}_{component}_{defect_line1}_{defect_line2}_{idd}.jpg"
     combined_image_path = os.path.join(output_folder, combined_image_name)
 
-    combined_image.save(combined_image_path)
+    # The result is opaque, so JPEG is much faster to encode than PNG
+    _save_overlay_image(combined_image, combined_image_path, "JPEG", quality=90, subsampling=2,
+                        exif=_output_exif(base_img))
 
     return combined_image_path
 
@@ -339,14 +456,14 @@ def draw_bottom_left_box2(draw, base_width, base_height, box_height, font, trans
 
     # Two text lines
     lines = [glocation, component]
+    ascent, descent = font.getmetrics()
+    text_height = ascent + descent
 
     for j, line in enumerate(lines):
         line = "" if line is None else str(line)
 
         # Measure text
-        text_bbox = draw.textbbox((0, 0), line, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        text_width = int(font.getlength(line))
 
         # Center text inside the box
         text_x = x_position + (box_width - text_width) // 2
@@ -362,36 +479,58 @@ def draw_bottom_left_box2(draw, base_width, base_height, box_height, font, trans
 if __name__ == "__main__":
     image_path = r"C:\Users\Admin\OneDrive\Documentos\CodingProjects\contextcam_clone\photos\IMG_1061.jpg"
     output_folder = "test"
-
-    info_tuple = get_comments_info(image_path)
-    if info_tuple is None:
-        raise ValueError("Image does not contain required GPS/DateTime EXIF data.")
-
-    cord1, cord2, date_month_year, hour_min_second, angle = info_tuple
-
-    create_standardized_overlay_image(
-        image_path=image_path,
-        cord1=cord1,
-        cord2=cord2,
-        date_month_year=date_month_year,
-        hour_min_second=hour_min_second,
-        angle=angle,
-        glocation="Microcell Building",
-        component="Monorail 5024",
-        defect_line1="Corrosion and ",
-        defect_line2="dmg in PCaaaa",
-        idd=3,
-        output_folder=output_folder,
-    )
+    os.makedirs(output_folder, exist_ok=True)
+
+    with load_image(image_path) as img:
+        info_tuple = get_comments_info_from_img(img)
+        if info_tuple is None:
+            raise ValueError("Image does not contain required GPS/DateTime EXIF data.")
+
+        cord1, cord2, date_month_year, hour_min_second, angle = info_tuple
+
+        create_standardized_overlay_image(
+            img,
+            cord1=cord1,
+            cord2=cord2,
+            date_month_year=date_month_year,
+            hour_min_second=hour_min_second,
+            angle=angle,
+            glocation="Microcell Building",
+            component="Monorail 5024",
+            defect_line1="Corrosion and ",
+            defect_line2="dmg in PCaaaa",
+            idd=3,
+            output_folder=output_folder,
+        )
 
 from PIL import ImageFilter
 
 from PIL import ImageFilter
 
+@lru_cache(maxsize=8)
+def _build_shade(box_width: int, box_height: int, max_alpha: int) -> Image.Image:
+    """
+    Build the black RGBA shade for the bottom-left box, its alpha 75% solid + 25% fade.
+    Cached per geometry, so callers must not modify the returned image.
+    """
+    full_shade_end = int(box_width * 0.75)
+    gradient_width = max(1, box_width - full_shade_end)
+
+    ramp = np.full(box_width, max_alpha, dtype=np.uint8)
+    t = np.arange(box_width - full_shade_end, dtype=np.float64) / gradient_width
+    ramp[full_shade_end:] = (max_alpha * (1 - t)).astype(np.uint8)
+
+    # The alpha is constant down each column: build one row, let Pillow stretch it
+    row = Image.fromarray(ramp[np.newaxis, :], "L")
+    mask = row.resize((box_width, box_height), Image.NEAREST)
+
+    shade = Image.new("RGBA", (box_width, box_height), (0, 0, 0, 0))
+    shade.putalpha(mask)
+    return shade
+
+
 def draw_bottom_left_box(
-    overlay_image,
     base_img,
-    draw,
     base_width,
     base_height,
     box_height,
@@ -404,6 +543,9 @@ def draw_bottom_left_box(
     Bottom-left overlay box:
     - Blurs the BASE image area first
     - Then draws darkening + gradient on top
+    The box is drawn on a transparent full-width layer running from the top of
+    the box (or its text, if higher) to the bottom of the image.
+    Returns (layer, layer_top), layer_top being its y in the base image.
     """
 
     # Ensure integers
@@ -415,59 +557,52 @@ def draw_bottom_left_box(
     max_alpha = max(0, min(int(transparency), 255))
 
     # --- 1) BLUR THE BASE IMAGE WHERE THE BOX WILL BE ---
-    blur_crop = base_img.crop(
-        (
+    # Downsample by 8x, smooth the small copy and upsample back: visually the
+    # same as a radius-20 Gaussian at full resolution, with 64x fewer pixels.
+    # resize(box=...) reads the region straight from the base image, so no
+    # full-size crop copy is made.
+    small = base_img.resize(
+        (max(1, box_width // 8), max(1, box_height // 8)),
+        Image.BOX,
+        box=(
             x_position,
             y_position,
             x_position + box_width,
             y_position + box_height,
-        )
-    ).filter(ImageFilter.GaussianBlur(radius=20))
+        ),
+    )
+    small = small.filter(ImageFilter.GaussianBlur(radius=2))
+    blur_crop = small.resize((box_width, box_height), Image.BILINEAR)
 
     # Paste blur BACK onto base image (we modify the base image directly)
     base_img.paste(blur_crop, (x_position, y_position))
 
-    # --- 2) Create a shading alpha mask for 75% solid + 25% fade ---
-    mask = Image.new("L", (box_width, box_height), 0)
-    mask_pixels = mask.load()
-
-    full_shade_end = int(box_width * 0.75)
-    gradient_width = max(1, box_width - full_shade_end)
-
-    for i in range(box_width):
-        if i < full_shade_end:
-            alpha = max_alpha
-        else:
-            t = (i - full_shade_end) / gradient_width
-            alpha = int(max_alpha * (1 - t))
-
-        for j in range(box_height):
-            mask_pixels[i, j] = alpha
-
-    # --- 3) Darkening overlay (black box using the alpha mask) ---
-    shade = Image.new("RGBA", (box_width, box_height), (0, 0, 0, 0))
-    shade_pixels = shade.load()
+    # --- 2) Layer for the box; text taller than the box can start above it ---
+    lines = [glocation, component]
+    ascent, descent = font.getmetrics()
+    text_height = ascent + descent
+    first_text_y = y_position + (box_height - text_height*len(lines))//2
 
-    for i in range(box_width):
-        for j in range(box_height):
-            a = mask_pixels[i, j]
-            shade_pixels[i, j] = (0, 0, 0, a)
+    layer_top = max(0, min(y_position, first_text_y))
+    layer = Image.new("RGBA", (base_width, base_height - layer_top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(layer, "RGBA")
 
-    # Paste the shaded gradient overlay
-    overlay_image.paste(shade, (x_position, y_position), shade)
+    # --- 3) Darkening overlay (cached black shade with the gradient alpha) ---
+    # Pasted with itself as mask, so each pixel ends up a 255*(1 - a/255) grey at
+    # alpha a*a/255. A solid colour through the mask can't reproduce that (it
+    # gives black at alpha a), so the RGBA shade stays; it is cached anyway.
+    shade = _build_shade(box_width, box_height, max_alpha)
+    layer.paste(shade, (x_position, y_position - layer_top), shade)
 
     # --- 4) Draw text on top of all ---
-    lines = [glocation, component]
-
     for j, line in enumerate(lines):
         line = "" if line is None else str(line)
 
-        text_bbox = draw.textbbox((0, 0), line, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+        text_width = int(font.getlength(line))
 
         text_x = x_position + (box_width - text_width) // 2
-        text_y = y_position + (box_height - text_height*len(lines))//2 + j*text_height
+        text_y = first_text_y + j*text_height
 
-        draw.text((int(text_x), int(text_y)), line, fill="white", font=font)
+        draw.text((int(text_x), int(text_y - layer_top)), line, fill="white", font=font)
 
+    return layer, layer_top
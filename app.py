@@ -1,204 +1,265 @@
 import os
-from typing import Tuple
-from openpyxl import Workbook
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple
+from openpyxl import Workbook, load_workbook
 from openpyxl.utils import get_column_letter
-from _testing_image_overlay import create_standardized_overlay_image,get_comments_info,copy_and_rotate, create_partial_overlay_image
-import pandas as pd
-from PIL import Image, ExifTags
+from _testing_image_overlay import create_standardized_overlay_image,get_comments_info_from_img, create_partial_overlay_image, load_image, ORIENTATION_TAG
+from PIL import Image
 import numpy as np
 from PIL import Image
-import piexif
-from pillow_heif import register_heif_opener
-
-# Register HEIC support
-register_heif_opener()
+from pillow_heif import open_heif
 
 def convert_heic_to_jpg(image_path):
     """
     Converts a HEIC image to JPG while preserving metadata and quality.
-    Returns the path to the new JPG file.
+    Returns the path to the new JPG file, or None if the conversion failed.
     """
     try:
         print(f"Opening file: {image_path}")
-        with Image.open(image_path) as img:
-            print('Inside function: Image opened successfully')
+        # open_heif skips Pillow's plugin dispatch; libheif releases the GIL while decoding
+        heif = open_heif(image_path, convert_hdr_to_8bit=True)
+        img = heif.to_pillow()
 
-            # Extract metadata
-            exif_data = img.info.get('exif')
-            print(f"EXIF data extracted: {exif_data is not None}")
+        # Extract metadata from the converted image, not heif.info: libheif has already
+        # applied the rotation, and only to_pillow() resets the Orientation tag to match
+        exif_data = img.info.get('exif')
+        print(f"EXIF data extracted: {exif_data is not None}")
 
-            # Prepare new file path
-            jpg_path = os.path.splitext(image_path)[0] + '.jpg'
-            print(f"Saving file as: {jpg_path}")
+        # Prepare new file path
+        jpg_path = os.path.splitext(image_path)[0] + '.jpg'
+        print(f"Saving file as: {jpg_path}")
 
-            # Save as JPG with the original quality and metadata
-            if exif_data:
-                img.save(jpg_path, 'JPEG', quality=100, exif=exif_data)
-            else:
-                img.save(jpg_path, 'JPEG', quality=100)
+        # Save as JPG with the original quality and metadata
+        if exif_data:
+            img.save(jpg_path, 'JPEG', quality=100, exif=exif_data)
+        else:
+            img.save(jpg_path, 'JPEG', quality=100)
 
-            print(f"File saved successfully at {jpg_path}")
-            return jpg_path
+        print(f"File saved successfully at {jpg_path}")
+        return jpg_path
 
     except Exception as e:
         print(f"Error converting {image_path}: {e}")
 
 
 
+# EXIF-derived columns filled in by scan_and_write_excel, in get_comments_info order
+EXIF_COLUMNS = ['cord1', 'cord2', 'date_month_year', 'hour_min_second', 'angle']
+
+# Used when neither the Excel nor the image EXIF has the fields
+DEFAULT_COMMENTS = (32.25315, 115.76708, '2024:06:12', '2024:06:12', -75)
+
+# What get_comments_info_from_img raises on missing or malformed GPS/DateTime EXIF
+# (e.g. a short DMS tuple, a bad or zero-denominator rational); the scan and the
+# processing step both handle exactly these
+EXIF_ERRORS = (KeyError, TypeError, AttributeError, IndexError, ValueError, ZeroDivisionError)
+
+
+def _rotation_from_img(img):
+    """
+    Returns the rotation (degrees CCW) needed to undo the image's EXIF Orientation, or 0.
+    """
+    orientation = img.getexif().get(ORIENTATION_TAG, 1)
+
+    # Map the orientation value to rotation angle
+    rotation_map = {
+        1: 0,    # Horizontal (normal)
+        3: 180,  # Upside-down
+        6: 270,  # Rotated 90° CW
+        8: 90    # Rotated 90° CCW
+    }
+
+    return rotation_map.get(orientation, 0)
+
+
 def get_image_rotation(image_path):
-    # Open the image file
+    """
+    Returns the rotation (degrees CCW) needed to undo the image's EXIF Orientation, or 0.
+    """
+    # getexif() only reads the header, the pixels are never decoded
     with Image.open(image_path) as img:
-        # Get the EXIF data
-        exif = img._getexif()
-        
-        if exif:
-            # Get the orientation tag code
-            for tag, value in ExifTags.TAGS.items():
-                if value == 'Orientation':
-                    orientation_tag = tag
-                    break
-            
-            # Get the orientation value
-            orientation = exif.get(orientation_tag, None)
-            
-            # Map the orientation value to rotation angle
-            rotation_map = {
-                1: 0,    # Horizontal (normal)
-                3: 180,  # Upside-down
-                6: 270,  # Rotated 90° CW
-                8: 90    # Rotated 90° CCW
-            }
-            
-            rotation_angle = rotation_map.get(orientation, 0)
-            return rotation_angle
-        else:
-            return "No EXIF data found"
+        return _rotation_from_img(img)
+
+
+def get_image_info(image_path):
+    """
+    Reads the rotation and the get_comments_info fields with a single open of the image.
+    The fields are None if the image lacks the needed EXIF data.
+    """
+    with Image.open(image_path) as img:
+        rotation = _rotation_from_img(img)
+        # Malformed EXIF in one file must not stop the whole scan; leave its cells blank
+        try:
+            comments = get_comments_info_from_img(img)
+        except EXIF_ERRORS as e:
+            print(f"Could not read EXIF info from {image_path}: {e}")
+            comments = None
+    return rotation, comments
+
+
+def _comments_from_row(row: dict):
+    """
+    Returns the get_comments_info fields stored in an Excel row, or None if any is
+    blank or a number column doesn't hold a number (e.g. after a hand edit).
+    """
+    cord1, cord2, date_month_year, hour_min_second, angle = (row.get(column) for column in EXIF_COLUMNS)
+    if any(value in (None, '') for value in (cord1, cord2, date_month_year, hour_min_second, angle)):
+        return None
+    try:
+        return float(cord1), float(cord2), str(date_month_year), str(hour_min_second), float(angle)
+    except (TypeError, ValueError):
+        return None
 
 
 def scan_and_write_excel(directory: str, excel_path: str) -> None:
     """
     Scans a directory for JPG and HEIC images, converts HEIC to JPG,
-    writes the paths and rotation info to an Excel file along with empty columns for additional data.
+    writes the paths, rotation and EXIF info to an Excel file along with empty columns for additional data.
     """
     wb = Workbook()
     ws = wb.active
 
-    columns = ['image_path', 'glocation', 'component', 'defect_line1', 'defect_line2', 'idd', 'rotation']
+    columns = ['image_path', 'glocation', 'component', 'defect_line1', 'defect_line2', 'idd', 'rotation'] + EXIF_COLUMNS
     ws.append(columns)
 
-    for file in os.listdir(directory):
-        print(file)
-        file_lower = file.lower()
-        image_path = os.path.join(directory, file)
+    image_paths = [os.path.join(directory, file) for file in os.listdir(directory)]
 
-        # Convert HEIC to JPG
-        if file_lower.endswith('.heic'):
-            image_path = convert_heic_to_jpg(image_path)
+    # Convert HEIC to JPG, several files at a time
+    heic_paths = [path for path in image_paths if path.lower().endswith('.heic')]
+    with ThreadPoolExecutor() as ex:
+        converted = dict(zip(heic_paths, ex.map(convert_heic_to_jpg, heic_paths)))
+
+    for image_path in image_paths:
+        print(os.path.basename(image_path))
+        if image_path in converted:
+            image_path = converted[image_path]
+            if image_path is None:
+                continue
 
         # Process JPG files
-        if image_path.lower().endswith('.jpg'):
-            rotation = get_image_rotation(image_path)
-            ws.append([image_path, '', '', '', '', '', rotation])
-        
-        # Process JPG files
-        if image_path.lower().endswith('.jpeg'):
-            rotation = get_image_rotation(image_path)
-            ws.append([image_path, '', '', '', '', '', rotation])
+        if image_path.lower().endswith(('.jpg', '.jpeg')):
+            rotation, comments = get_image_info(image_path)
+            if comments is None:
+                comments = [''] * len(EXIF_COLUMNS)
+            ws.append([image_path, '', '', '', '', '', rotation, *comments])
 
     wb.save(excel_path)
 
-def process_images_from_excel(excel_path: str,output_folder:str) -> None:
+def _read_excel_rows(excel_path: str) -> List[dict]:
+    """
+    Reads the active sheet of the Excel file as a list of {column: value} dicts.
+    The first row is the header; blank rows are skipped.
+    """
+    wb = load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        header = None
+        rows = []
+        for values in ws.iter_rows(values_only=True):
+            if header is None:
+                header = values
+                continue
+            if all(value is None for value in values):
+                continue
+            rows.append(dict(zip(header, values)))
+        return rows
+    finally:
+        wb.close()
+
+
+def _process_one_row(row: dict, output_folder: str, overlay_func=create_standardized_overlay_image,
+                     with_rotation: bool = True, max_dim: Optional[int] = None) -> str:
+    """
+    Processes a single Excel row: rotates the image if requested, reads its EXIF and applies the overlay.
+    If max_dim is given, the image is downscaled to fit it before the overlay is drawn.
+    Module-level so it can be pickled and sent to worker processes.
+    """
+    image_path = row['image_path']
+
+    # Prefer the EXIF fields stored by scan_and_write_excel, so EXIF isn't parsed again
+    comments = _comments_from_row(row)
+
+    # Decode the image once and reuse it for EXIF, the rotation and the overlay
+    with load_image(image_path, max_dim) as img:
+        if comments is not None:
+            cord1, cord2, date_month_year, hour_min_second, angle = comments
+        elif with_rotation:
+            try:
+                cord1, cord2, date_month_year, hour_min_second, angle = get_comments_info_from_img(img)
+            except EXIF_ERRORS:
+                cord1, cord2, date_month_year, hour_min_second, angle = DEFAULT_COMMENTS
+        else:
+            cord1, cord2, date_month_year, hour_min_second, angle = get_comments_info_from_img(img)
+
+        # Rotate in memory, the same way copy_and_rotate does, without a temporary JPEG
+        if with_rotation and row['rotation']:
+            img = img.rotate(row['rotation'], expand=True)
+
+        # Call the function with the data from the Excel and the extracted information
+        return overlay_func(img,
+                            cord1=cord1,
+                            cord2=cord2,
+                            date_month_year=date_month_year,
+                            hour_min_second=hour_min_second,
+                            angle=angle,
+                            glocation=row['glocation'],
+                            component=row['component'],
+                            defect_line1=row['defect_line1'],
+                            defect_line2=row['defect_line2'],
+                            idd=row['idd'],
+                            output_folder = output_folder)
+
+
+def _process_rows(rows: List[dict], output_folder: str, overlay_func, with_rotation: bool,
+                  max_dim: Optional[int] = None) -> List[str]:
+    """
+    Processes the rows in parallel, one image per worker process.
+    Workers share no temporary files, since rotation happens in memory, and outputs
+    are moved into place atomically, so rows naming the same image or output are safe.
+    Returns the saved image paths in row order.
+    """
+    # Create the folder once, up front; the overlay functions no longer check it per image
+    os.makedirs(output_folder, exist_ok=True)
+
+    worker = partial(_process_one_row, output_folder=output_folder,
+                     overlay_func=overlay_func, with_rotation=with_rotation, max_dim=max_dim)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        return list(ex.map(worker, rows))
+
+
+def process_images_from_excel(excel_path: str,output_folder:str, max_dim: Optional[int] = None) -> None:
     """
     Reads the Excel file and processes each image using the provided details.
+    Pass max_dim (e.g. 1920) to produce downscaled outputs with a faster JPEG decode.
     """
     # Load the Excel file
-    df = pd.read_excel(excel_path)
+    rows = _read_excel_rows(excel_path)
 
-    for index, row in df.iterrows():
-        image_path = row['image_path']
-        # Assuming get_comments_info is defined elsewhere and available
-        cord1, cord2, date_month_year, hour_min_second, angle = get_comments_info(image_path)
-        
-        # Call the function with the data from the Excel and the extracted information
-        create_standardized_overlay_image(image_path,
-                                          cord1=cord1,
-                                          cord2=cord2,
-                                          date_month_year=date_month_year,
-                                          hour_min_second=hour_min_second,
-                                          angle=angle,
-                                          glocation=row['glocation'],
-                                          component=row['component'],
-                                          defect_line1=row['defect_line1'],
-                                          defect_line2=row['defect_line2'],
-                                          idd=row['idd'],
-                                          output_folder = output_folder)
+    _process_rows(rows, output_folder, create_standardized_overlay_image, with_rotation=False, max_dim=max_dim)
 
 
 
-def process_images_from_excel_with_rotation(excel_path: str,output_folder:str) -> None:
+def process_images_from_excel_with_rotation(excel_path: str,output_folder:str, max_dim: Optional[int] = None) -> None:
     """
     Reads the Excel file and processes each image using the provided details.
+    Pass max_dim (e.g. 1920) to produce downscaled outputs with a faster JPEG decode.
     """
     # Load the Excel file
-    df = pd.read_excel(excel_path)
-
-    for index, row in df.iterrows():
-        image_path = row['image_path']
-        # Assuming get_comments_info is defined elsewhere and available
-        if row['rotation'] != 0:
-            image_path = copy_and_rotate(image_path,row['rotation'])
-            print('path' ,image_path)
-        try:
-            cord1, cord2, date_month_year, hour_min_second, angle = get_comments_info(image_path)
-        except:
-            cord1, cord2, date_month_year, hour_min_second, angle = 32.25315, 115.76708, '2024:06:12', '2024:06:12', -75
+    rows = _read_excel_rows(excel_path)
 
-        # Call the function with the data from the Excel and the extracted information
-        create_standardized_overlay_image(image_path,
-                                          cord1=cord1,
-                                          cord2=cord2,
-                                          date_month_year=date_month_year,
-                                          hour_min_second=hour_min_second,
-                                          angle=angle,
-                                          glocation=row['glocation'],
-                                          component=row['component'],
-                                          defect_line1=row['defect_line1'],
-                                          defect_line2=row['defect_line2'],
-                                          idd=row['idd'],
-                                          output_folder = output_folder)
-
-
-def process_partial_images_from_excel_with_rotation(excel_path: str,output_folder:str) -> None:
+    _process_rows(rows, output_folder, create_standardized_overlay_image, with_rotation=True, max_dim=max_dim)
+
+
+def process_partial_images_from_excel_with_rotation(excel_path: str,output_folder:str, max_dim: Optional[int] = None) -> None:
     """
     Reads the Excel file and processes each image using the provided details.
+    Pass max_dim (e.g. 1920) to produce downscaled outputs with a faster JPEG decode.
     """
     # Load the Excel file
-    df = pd.read_excel(excel_path)
-
-    for index, row in df.iterrows():
-        image_path = row['image_path']
-        # Assuming get_comments_info is defined elsewhere and available
-        if row['rotation'] != 0:
-            image_path = copy_and_rotate(image_path,row['rotation'])
-            print('path' ,image_path)
-        try:
-            cord1, cord2, date_month_year, hour_min_second, angle = get_comments_info(image_path)
-        except:
-            cord1, cord2, date_month_year, hour_min_second, angle = 32.25315, 115.76708, '2024:06:12', '2024:06:12', -75
+    rows = _read_excel_rows(excel_path)
 
-        # Call the function with the data from the Excel and the extracted information
-        create_partial_overlay_image(image_path,
-                                          cord1=cord1,
-                                          cord2=cord2,
-                                          date_month_year=date_month_year,
-                                          hour_min_second=hour_min_second,
-                                          angle=angle,
-                                          glocation=row['glocation'],
-                                          component=row['component'],
-                                          defect_line1=row['defect_line1'],
-                                          defect_line2=row['defect_line2'],
-                                          idd=row['idd'],
-                                          output_folder = output_folder)
+    _process_rows(rows, output_folder, create_partial_overlay_image, with_rotation=True, max_dim=max_dim)
 # Example usage
 if __name__ == '__main__':
     directory = r"C:\Users\Admin\OneDrive\Documentos\CodingProjects\contextcam_clone\belt_filter"